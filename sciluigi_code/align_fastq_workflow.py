@@ -3,10 +3,11 @@
 
 import os
 import argparse
-import pandas as pd
 import sciluigi as sl
 from general_tasks import LoadFile
+from general_tasks import read_metadata
 from general_tasks import AlignFastqTask
+from general_tasks import sciluigi_cmdline_args
 from sra_tasks import ImportSRAFastq
 
 
@@ -37,14 +38,12 @@ class AlignFastsqWorkflow(sl.WorkflowTask):
         assert self.input_location in ["SRA", "S3"]
 
         # Read in the metadata sheet
-        metadata = pd.read_table(self.metadata_fp, sep=self.metadata_fp_sep)
-
-        for col_name in [self.input_column_name, self.sample_column_name]:
-            assert col_name in metadata.columns, "{} not found in {}".format(
-                col_name, self.metadata_fp
-            )
-            # Make sure that all samples and files are unique
-            assert metadata[col_name].unique().shape[0] == metadata.shape[0]
+        sample_rows = read_metadata(
+            self.metadata_fp,
+            self.metadata_fp_sep,
+            self.sample_column_name,
+            self.input_column_name
+        )
 
         # Make tasks that will make sure the reference databases exist
         ref_fasta = self.new_task(
@@ -60,11 +59,7 @@ class AlignFastsqWorkflow(sl.WorkflowTask):
         tasks_align_bwa = {}
 
         # Iterate over all of the rows of samples
-        for ix, r in metadata.iterrows():
-
-            # Get the sample name and the file location
-            sample_name = r[self.sample_column_name]
-            input_path = r[self.input_column_name]
+        for sample_name, input_path in sample_rows:
 
             # If the inputs are on SRA, execute jobs that will download them
             if self.input_location == "SRA":
@@ -244,10 +239,5 @@ if __name__ == "__main__":
 
     sl.run(
         main_task_cls=AlignFastsqWorkflow,
-        cmdline_args=[
-            "--{}={}".format(
-                k.replace("_", "-"),
-                v)
-            for k, v in args.__dict__.items()
-        ]
+        cmdline_args=sciluigi_cmdline_args(args)
     )
@@ -3,8 +3,10 @@
 
 import os
 import argparse
+import luigi
 import sciluigi as sl
 from general_tasks import LoadFile
+from general_tasks import sciluigi_cmdline_args
 from assembly_tasks import AnnotateProkka, CheckM
 
 
@@ -15,6 +17,9 @@ class AnnotateGenomeWorkflow(sl.WorkflowTask):
     genome_name = sl.Parameter()
     checkm_memory = sl.Parameter(default=64000)
     checkm_threads = sl.Parameter(default=8)
+    checkm_reduced_tree = luigi.BoolParameter(default=False)
+    prokka_cache_folder = sl.Parameter(default="")
+    checkm_cache_folder = sl.Parameter(default="")
     base_s3_folder = sl.Parameter()
     aws_job_role_arn = sl.Parameter()
     aws_s3_scratch_loc = sl.Parameter()
@@ -39,6 +44,7 @@ class AnnotateGenomeWorkflow(sl.WorkflowTask):
             output_folder=os.path.join(self.base_s3_folder, "prokka"),
             threads=self.checkm_threads,
             temp_folder=self.temp_folder,
+            cache_folder=self.prokka_cache_folder,
             containerinfo=sl.ContainerInfo(
                 vcpu=int(self.checkm_threads),
                 mem=int(self.checkm_memory),
@@ -67,9 +73,12 @@ class AnnotateGenomeWorkflow(sl.WorkflowTask):
             output_folder=os.path.join(self.base_s3_folder, "checkm"),
             threads=8,
             temp_folder=self.temp_folder,
+            reduced_tree=self.checkm_reduced_tree,
+            cache_folder=self.checkm_cache_folder,
             containerinfo=sl.ContainerInfo(
                 vcpu=int(8),
-                mem=int(64000),
+                # The reduced reference tree fits in much less memory
+                mem=16000 if self.checkm_reduced_tree else 64000,
                 engine=self.engine,
                 aws_s3_scratch_loc=self.aws_s3_scratch_loc,
                 aws_jobRoleArn=self.aws_job_role_arn,
@@ -114,6 +123,26 @@ if __name__ == "__main__":
         required=True
     )
 
+    parser.add_argument(
+        "--prokka-cache-folder",
+        help="Folder (S3) used to share Prokka results between runs",
+        type=str,
+        default=""
+    )
+
+    parser.add_argument(
+        "--checkm-cache-folder",
+        help="Folder (S3) used to share CheckM results between runs",
+        type=str,
+        default=""
+    )
+
+    parser.add_argument(
+        "--checkm-reduced-tree",
+        help="Run CheckM with the reduced reference tree (~14Gb of memory)",
+        action="store_true"
+    )
+
     parser.add_argument(
         "--aws-job-role-arn",
         help="Job Role ARN to use with AWS Batch",
@@ -151,10 +180,5 @@ if __name__ == "__main__":
 
     sl.run(
         main_task_cls=AnnotateGenomeWorkflow,
-        cmdline_args=[
-            "--{}={}".format(
-                k.replace("_", "-"),
-                v)
-            for k, v in args.__dict__.items()
-        ]
+        cmdline_args=sciluigi_cmdline_args(args)
     )
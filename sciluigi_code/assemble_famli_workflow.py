@@ -2,19 +2,29 @@
 """Assemble a set of FASTQ files, combine the assemblies, and align with FAMLI."""
 
 import os
-import re
-import uuid
 import argparse
-import pandas as pd
+from hashlib import blake2s
+from collections import namedtuple
 import sciluigi as sl
 from general_tasks import LoadFile
-from general_tasks import FastqpTask
+from general_tasks import read_metadata
+from general_tasks import BinpackedFastqpTask
 from general_tasks import FAMLITask
+from general_tasks import batch_job_name
+from general_tasks import batch_container_kwargs
+from general_tasks import docker_scratch_mount
+from general_tasks import sciluigi_cmdline_args
 from assembly_tasks import AssembleMetaSPAdes
 from assembly_tasks import AnnotateProkka
 from assembly_tasks import IntegrateAssembliesTask
 from sra_tasks import ImportSRAFastq
 
+# All of the per-sample tasks in AssembleFamliWorkflow
+SampleTasks = namedtuple(
+    "SampleTasks",
+    ["metaspades", "prokka", "famli"]
+)
+
 
 class AssembleFamliWorkflow(sl.WorkflowTask):
 
@@ -33,299 +43,262 @@ class AssembleFamliWorkflow(sl.WorkflowTask):
     metaphlan_mem = sl.Parameter(default=32000)
     humann2_threads = sl.Parameter(default=8)
     humann2_mem = sl.Parameter(default=32000)
+    prokka_cache_folder = sl.Parameter(default="")
+    fastqp_batch_size = sl.Parameter(default=5)
     aws_job_role_arn = sl.Parameter()
     aws_s3_scratch_loc = sl.Parameter()
     aws_batch_job_queue = sl.Parameter(default="optimal")
     engine = sl.Parameter(default="aws_batch")
     temp_folder = "/scratch"
 
+    # Tasks built by the first call to workflow()
+    _workflow_output = None
+
     def workflow(self):
 
+        # luigi asks a workflow for its requirements more than once, so only
+        # read the metadata and build the tasks the first time around
+        if self._workflow_output is not None:
+            return self._workflow_output
+
         # Make sure the project name is alphanumeric
-        assert all([
-            s.isalnum() or s == "_"
-            for s in self.project_name
-        ]), "Project name must be alphanumeric"
+        assert self.project_name.replace("_", "").isalnum(), \
+            "Project name must be alphanumeric"
 
         # Data can come from either SRA or S3
         assert self.input_location in ["SRA", "S3"]
 
         # Read in the metadata sheet
-        metadata = pd.read_table(self.metadata_fp, sep=self.metadata_fp_sep)
+        sample_rows = read_metadata(
+            self.metadata_fp,
+            self.metadata_fp_sep,
+            self.sample_column_name,
+            self.input_column_name
+        )
 
-        for col_name in [self.input_column_name, self.sample_column_name]:
-            assert col_name in metadata.columns, "{} not found in {}".format(
-                col_name, self.metadata_fp
-            )
-            # Make sure that all samples and files are unique
-            assert metadata[col_name].unique().shape[0] == metadata.shape[0]
+        # Jobs can be submitted to more than one queue (comma-separated), so
+        # that a lack of capacity behind one queue doesn't hold up every sample
+        job_queues = self.aws_batch_job_queue.split(",")
 
-        # Keep track of the jobs for each step, for each sample
-        tasks_load_inputs = {}
-        tasks_fastqp = {}
-        tasks_metaspades = {}
-        tasks_prokka = {}
-        tasks_famli = {}
+        container_kwargs = batch_container_kwargs(
+            self,
+            aws_batch_job_poll_sec=120,
+            aws_batch_job_queue=job_queues[0],
+            mounts=docker_scratch_mount(self.temp_folder)
+        )
+        # Folders for the outputs of each step
+        base_s3_folder = self.base_s3_folder.rstrip("/")
+        fastqp_folder = f"{base_s3_folder}/fastqp"
+        metaspades_folder = f"{base_s3_folder}/metaspades"
+        prokka_folder = f"{base_s3_folder}/prokka"
+        famli_folder = f"{base_s3_folder}/famli"
+        integrated_assembly_folder = f"{base_s3_folder}/integrated_assembly"
+
+        assemble_threads = int(self.assemble_threads)
+        assemble_mem = int(self.assemble_mem)
+
+        # Pick the way that the input files are loaded, once for all samples
+        if self.input_location == "S3":
+            load_input = self._load_from_s3
+        else:
+            load_input = self._load_from_sra
+
+        # Keep track of the jobs for each sample
+        samples = {}
+
+        # Each fastqp job runs a small, fixed number of samples. That saves
+        # provisioning a job for every sample, while bounding the scratch space
+        # used by each job and the number of samples one bad input can hold up
+        fastqp_batch_size = int(self.fastqp_batch_size)
+        assert fastqp_batch_size > 0, "fastqp_batch_size must be positive"
+        fastqp_tasks = []
 
         # Iterate over all of the rows of samples
-        for _, r in metadata.iterrows():
-
-            # Get the sample name and the file location
-            sample_name = r[self.sample_column_name]
-            input_path = r[self.input_column_name]
+        for ix, (sample_name, input_path) in enumerate(sample_rows):
 
-            # Make a UUID to isolate temp files for this task from any others
-            task_uuid = str(uuid.uuid4())[:8]
+            # Spread the samples evenly across all of the job queues
+            sample_container_kwargs = dict(
+                container_kwargs,
+                aws_batch_job_queue=job_queues[ix % len(job_queues)]
+            )
 
             # 1. LOAD THE INPUT FILES
-            
-            if self.input_location == "S3":
-                tasks_load_inputs[sample_name] = self.new_task(
-                    "load_from_s3_{}".format(sample_name),
-                    LoadFile,
-                    path=input_path
-                )
-            elif self.input_location == "SRA":
-                assert input_path.startswith("SRR"), input_path
-
-                tasks_load_inputs[sample_name] = self.new_task(
-                    "download_from_SRA_{}".format(sample_name),
-                    ImportSRAFastq,
-                    sra_accession=input_path,
-                    base_s3_folder=self.base_s3_folder,
-                    input_mount_point="/scratch/{}_get_sra/input/".format(
-                        task_uuid),
-                    output_mount_point="/scratch/{}_get_sra/output/".format(
-                        task_uuid),
-                    containerinfo=sl.ContainerInfo(
-                        vcpu=1,
-                        mem=32000,
-                        engine=self.engine,
-                        aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                        aws_batch_job_poll_sec=120,
-                        aws_jobRoleArn=self.aws_job_role_arn,
-                        aws_batch_job_queue=self.aws_batch_job_queue,
-                        aws_batch_job_prefix=re.sub(
-                            '[^a-zA-Z0-9-_]', '_',
-                            "get_sra_{}".format(sample_name)
-                        ),
-                        mounts={
-                            "/docker_scratch": {
-                                "bind": self.temp_folder,
-                                "mode": "rw"
-                            }
-                        }
-                    )
-                )
-            else:
-                raise Exception("Data must be from S3 or SRA")
-            
-            # 2. CALCULATE FASTQ QUALITY METRICS
-            tasks_fastqp[sample_name] = self.new_task(
-                "fastqp_{}".format(sample_name),
-                FastqpTask,
-                summary_path=os.path.join(
-                    self.base_s3_folder,
-                    "fastqp",
-                    sample_name + ".fastqp.tsv"
-                ),
-                input_mount_point="/scratch/{}_fastqp/input/".format(task_uuid),
-                output_mount_point="/scratch/{}_fastqp/output/".format(task_uuid),
-                containerinfo=sl.ContainerInfo(
-                    vcpu=1,
-                    mem=32000,
-                    engine=self.engine,
-                    aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                    aws_batch_job_poll_sec=120,
-                    aws_jobRoleArn=self.aws_job_role_arn,
-                    aws_batch_job_queue=self.aws_batch_job_queue,
-                    aws_batch_job_prefix=re.sub(
-                        '[^a-zA-Z0-9-_]', '_',
-                        "fastqp_{}".format(sample_name)
-                    ),
-                    mounts={
-                        "/docker_scratch": {
-                            "bind": self.temp_folder,
-                            "mode": "rw"
-                        }
-                    }
-                )
+            task_load, fastq = load_input(
+                sample_name,
+                input_path,
+                sample_container_kwargs
             )
 
+            # 2. CALCULATE FASTQ QUALITY METRICS (in batches of samples)
+            if ix % fastqp_batch_size == 0:
+                fastqp_tasks.append(self._fastqp_batch(
+                    len(fastqp_tasks),
+                    fastqp_folder,
+                    sample_container_kwargs
+                ))
+            fastqp_tasks[-1].in_fastq_dict[sample_name] = fastq
+
             # 3. ASSEMBLE WITH METASPADES
-            tasks_metaspades[sample_name] = self.new_task(
+            task_metaspades = self.new_task(
                 "metaspades_{}".format(sample_name),
                 AssembleMetaSPAdes,
                 sample_name=sample_name,
-                output_folder=os.path.join(
-                    self.base_s3_folder,
-                    "metaspades"
-                ),
-                threads=self.assemble_threads,
-                max_mem=int(int(self.assemble_mem)/1000),
+                output_folder=metaspades_folder,
+                threads=assemble_threads,
+                max_mem=int(assemble_mem/1000),
                 temp_folder=self.temp_folder,
                 containerinfo=sl.ContainerInfo(
-                    vcpu=int(self.assemble_threads),
-                    mem=int(self.assemble_mem),
-                    engine=self.engine,
-                    aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                    aws_batch_job_poll_sec=120,
-                    aws_jobRoleArn=self.aws_job_role_arn,
-                    aws_batch_job_queue=self.aws_batch_job_queue,
-                    aws_batch_job_prefix=re.sub(
-                        '[^a-zA-Z0-9-_]', '_',
+                    vcpu=assemble_threads,
+                    mem=assemble_mem,
+                    **sample_container_kwargs,
+                    aws_batch_job_prefix=batch_job_name(
                         "metaspades_{}".format(sample_name)
-                    ),
-                    mounts={
-                        "/docker_scratch": {
-                            "bind": self.temp_folder,
-                            "mode": "rw"
-                        }
-                    }
+                    )
                 )
             )
+            task_metaspades.in_fastq = fastq
 
             # 4. ANNOTATE ASSEMBLIES WITH PROKKA
-            tasks_prokka[sample_name] = self.new_task(
+            task_prokka = self.new_task(
                 "prokka_{}".format(sample_name),
                 AnnotateProkka,
                 sample_name=sample_name,
-                output_folder=os.path.join(
-                    self.base_s3_folder,
-                    "prokka"
-                ),
-                threads=self.assemble_threads,
+                output_folder=prokka_folder,
+                threads=assemble_threads,
                 temp_folder=self.temp_folder,
+                cache_folder=self.prokka_cache_folder,
                 containerinfo=sl.ContainerInfo(
-                    vcpu=int(self.assemble_threads),
-                    mem=int(self.assemble_mem),
-                    engine=self.engine,
-                    aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                    aws_batch_job_poll_sec=120,
-                    aws_jobRoleArn=self.aws_job_role_arn,
-                    aws_batch_job_queue=self.aws_batch_job_queue,
-                    aws_batch_job_prefix=re.sub(
-                        '[^a-zA-Z0-9-_]', '_',
+                    vcpu=assemble_threads,
+                    mem=assemble_mem,
+                    **sample_container_kwargs,
+                    aws_batch_job_prefix=batch_job_name(
                         "prokka_{}".format(sample_name)
-                    ),
-                    mounts={
-                        "/docker_scratch": {
-                            "bind": self.temp_folder,
-                            "mode": "rw"
-                        }
-                    }
+                    )
                 )
             )
+            task_prokka.in_fasta = task_metaspades.out_fasta
 
+            # 5. ALIGN AGAINST THE ASSEMBLY USING FAMLI
+            task_famli = self.new_task(
+                "famli_{}".format(sample_name),
+                FAMLITask,
+                sample_name=sample_name,
+                output_folder=famli_folder,
+                threads=self.famli_threads,
+                temp_folder=self.temp_folder,
+                containerinfo=sl.ContainerInfo(
+                    vcpu=int(self.famli_threads),
+                    mem=int(self.famli_mem),
+                    **sample_container_kwargs,
+                    aws_batch_job_prefix="famli_{}".format(sample_name)
+                )
+            )
+            # Connect the raw FASTQ input
+            task_famli.in_fastq = fastq
 
+            samples[sample_name] = SampleTasks(
+                metaspades=task_metaspades,
+                prokka=task_prokka,
+                famli=task_famli
+            )
 
-        # Assign the output from tasks_load_inputs to the input to tasks_fastqp
-        for sample_name in tasks_load_inputs:
-            assert sample_name in tasks_fastqp
-
-            if self.input_location == "S3":
-                tasks_fastqp[sample_name].in_fastq = tasks_load_inputs[sample_name].out_file
-            elif self.input_location == "SRA":
-                tasks_fastqp[sample_name].in_fastq = tasks_load_inputs[sample_name].out_fastq
-
-            assert sample_name in tasks_metaspades
-            if self.input_location == "S3":
-                tasks_metaspades[sample_name].in_fastq = tasks_load_inputs[sample_name].out_file
-            elif self.input_location == "SRA":
-                tasks_metaspades[sample_name].in_fastq = tasks_load_inputs[sample_name].out_fastq
-
-            assert sample_name in tasks_prokka
-            tasks_prokka[sample_name].in_fasta = tasks_metaspades[sample_name].out_fasta
-
-        # 5. COMBINE ASSEMBLIES
+        # 6. COMBINE ASSEMBLIES (the reference database for FAMLI)
         task_integrate_assemblies = self.new_task(
             "integrate_assemblies-{}".format(self.project_name),
             IntegrateAssembliesTask,
             output_prefix=self.project_name,
-            output_folder=os.path.join(
-                self.base_s3_folder,
-                "integrated_assembly"
-            ),
-            gff_folder=os.path.join(
-                self.base_s3_folder,
-                "prokka"
-            ),
-            fastp_folder=os.path.join(
-                self.base_s3_folder,
-                "prokka"
-            ),
+            output_folder=integrated_assembly_folder,
+            gff_folder=prokka_folder,
+            fastp_folder=prokka_folder,
             temp_folder=self.temp_folder,
             containerinfo=sl.ContainerInfo(
                 vcpu=8,
                 mem=120000,
-                engine=self.engine,
-                aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                aws_batch_job_poll_sec=120,
-                aws_jobRoleArn=self.aws_job_role_arn,
-                aws_batch_job_queue=self.aws_batch_job_queue,
-                aws_batch_job_prefix="integrate_assemblies_{}".format(self.project_name),
-                mounts={
-                    "/docker_scratch": {
-                        "bind": self.temp_folder,
-                        "mode": "rw"
-                    }
-                }
+                **container_kwargs,
+                aws_batch_job_prefix="integrate_assemblies_{}".format(self.project_name)
             )
         )
 
         task_integrate_assemblies.in_fastp_list = [
-            t.out_faa for t in tasks_prokka.values()
+            t.prokka.out_faa for t in samples.values()
         ]
         task_integrate_assemblies.in_gff_list = [
-            t.out_gff for t in tasks_prokka.values()
+            t.prokka.out_gff for t in samples.values()
         ]
 
-        # 6. ALIGN AGAINST THE ASSEMBLY USING FAMLI
-        tasks_famli = {}
-        # Iterate over all of the rows of samples
-        for _, r in metadata.iterrows():
+        # Connect the reference database for FAMLI
+        for t in samples.values():
+            t.famli.in_ref_dmnd = task_integrate_assemblies.out_daa
 
-            # Get the sample name and the file location
-            sample_name = r[self.sample_column_name]
-            input_path = r[self.input_column_name]
+        self._workflow_output = (
+            [t.famli for t in samples.values()],
+            fastqp_tasks
+        )
 
-            tasks_famli[sample_name] = self.new_task(
-                "famli_{}".format(sample_name),
-                FAMLITask,
-                sample_name=sample_name,
-                output_folder=os.path.join(
-                    self.base_s3_folder,
-                    "famli"
-                ),
-                threads=self.famli_threads,
-                temp_folder=self.temp_folder,
-                containerinfo=sl.ContainerInfo(
-                    vcpu=int(self.famli_threads),
-                    mem=int(self.famli_mem),
-                    engine=self.engine,
-                    aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                    aws_batch_job_poll_sec=120,
-                    aws_jobRoleArn=self.aws_job_role_arn,
-                    aws_batch_job_queue=self.aws_batch_job_queue,
-                    aws_batch_job_prefix="famli_{}".format(sample_name),
-                    mounts={
-                        "/docker_scratch": {
-                            "bind": self.temp_folder,
-                            "mode": "rw"
-                        }
-                    }
-                )
+        return self._workflow_output
+
+    def _fastqp_batch(self, batch_ix, fastqp_folder, container_kwargs):
+        """Make a task to run fastqp on a batch of samples, which are added to it later."""
+
+        # Make an ID to isolate temp files for this task from any others,
+        # which stays the same if the workflow is run again
+        task_uuid = blake2s(
+            "{}_{}".format(self.project_name, batch_ix).encode(),
+            digest_size=4
+        ).hexdigest()
+
+        task_fastqp = self.new_task(
+            "fastqp_{}_{}".format(self.project_name, batch_ix),
+            BinpackedFastqpTask,
+            summary_folder=fastqp_folder,
+            input_mount_point="/scratch/{}_fastqp/input/".format(task_uuid),
+            output_mount_point="/scratch/{}_fastqp/output/".format(task_uuid),
+            containerinfo=sl.ContainerInfo(
+                vcpu=1,
+                mem=32000,
+                **container_kwargs,
+                aws_batch_job_prefix="fastqp_{}_{}".format(self.project_name, batch_ix)
             )
-            # Connect the raw FASTQ input
-            if self.input_location == "S3":
-                tasks_famli[sample_name].in_fastq = tasks_load_inputs[sample_name].out_file
-            elif self.input_location == "SRA":
-                tasks_famli[sample_name].in_fastq = tasks_load_inputs[sample_name].out_fastq
+        )
+        task_fastqp.in_fastq_dict = {}
 
-            # Connect the reference database
-            tasks_famli[sample_name].in_ref_dmnd = task_integrate_assemblies.out_daa
+        return task_fastqp
+
+    def _load_from_s3(self, sample_name, input_path, container_kwargs):
+        """Make a task for an input FASTQ which is already in S3."""
+
+        # container_kwargs is not needed here, but is taken so that both
+        # loaders can be called in the same way
+
+        task_load = self.new_task(
+            "load_from_s3_{}".format(sample_name),
+            LoadFile,
+            path=input_path
+        )
 
-        return tasks_famli, tasks_fastqp
+        return task_load, task_load.out_file
+
+    def _load_from_sra(self, sample_name, input_path, container_kwargs):
+        """Make a task to download an input FASTQ from SRA."""
+
+        assert input_path.startswith("SRR"), input_path
+
+        task_load = self.new_task(
+            "download_from_SRA_{}".format(sample_name),
+            ImportSRAFastq,
+            sra_accession=input_path,
+            base_s3_folder=self.base_s3_folder,
+            containerinfo=sl.ContainerInfo(
+                vcpu=1,
+                mem=32000,
+                **container_kwargs,
+                aws_batch_job_prefix=batch_job_name(
+                    "get_sra_{}".format(sample_name)
+                )
+            )
+        )
+
+        return task_load, task_load.out_fastq
 
 
 if __name__ == "__main__":
@@ -391,6 +364,20 @@ if __name__ == "__main__":
         help = "Memory to use for assembly with metaSPAdes (MBs)"
     )
 
+    parser.add_argument(
+        "--prokka-cache-folder",
+        help = "Folder (S3) used to share Prokka results between runs",
+        type = str,
+        default = ""
+    )
+
+    parser.add_argument(
+        "--fastqp-batch-size",
+        type = int,
+        default = 5,
+        help = "Number of samples to run through fastqp in each job"
+    )
+
     parser.add_argument(
         "--famli-threads",
         type = int,
@@ -413,7 +400,7 @@ if __name__ == "__main__":
 
     parser.add_argument(
         "--aws-batch-job-queue",
-        help="Job Queue to use with AWS Batch",
+        help="Job Queue to use with AWS Batch (comma-separated to use several)",
         type=str,
         default="optimal"
     )
@@ -444,10 +431,5 @@ if __name__ == "__main__":
 
     sl.run(
         main_task_cls = AssembleFamliWorkflow,
-        cmdline_args = [
-            "--{}={}".format(
-                k.replace("_", "-"),
-                v)
-            for k, v in args.__dict__.items()
-        ]
+        cmdline_args = sciluigi_cmdline_args(args)
     )
@@ -1,6 +1,44 @@
 import os
-import uuid
+import shlex
+import hashlib
+import functools
+import itertools
+import luigi
 import sciluigi as sl
+from general_tasks import FolderParameter
+from general_tasks import s3_path_exists
+from general_tasks import copy_s3_object
+from general_tasks import s3_sha256
+
+
+# Counter used to give every temp directory made by this process its own name
+_temp_dir_counter = itertools.count()
+
+
+def temp_dir_name():
+    """Name for a temp directory that is unique within this (forked) process."""
+    return "{:x}_{:08x}".format(os.getpid(), next(_temp_dir_counter))
+
+
+def cache_target(out_method):
+    """Only build the target returned by an out_* method once per task."""
+    cache_attr = "_cached_" + out_method.__name__
+
+    @functools.wraps(out_method)
+    def wrapper(self):
+        if cache_attr not in self.__dict__:
+            self.__dict__[cache_attr] = out_method(self)
+        return self.__dict__[cache_attr]
+
+    return wrapper
+
+
+def cache_key(input_path, *settings):
+    """Key for results cached in S3, from the contents of the input and anything else in the output."""
+    checksum = hashlib.sha256(s3_sha256(input_path, gunzip=True).encode())
+    for setting in settings:
+        checksum.update("\n{}".format(setting).encode())
+    return checksum.hexdigest()
 
 
 class AssembleMetaSPAdes(sl.ContainerTask):
@@ -10,9 +48,9 @@ class AssembleMetaSPAdes(sl.ContainerTask):
     # Sample name
     sample_name = sl.Parameter()
     # Output folder
-    output_folder = sl.Parameter()
+    output_folder = FolderParameter()
     # Number of threads to use
-    threads = sl.Parameter(default=4)
+    threads = sl.Parameter(default=3)
     # Maximum amount of memory to use (gigabytes)
     max_mem = sl.Parameter(default=10)
     # Scratch directory
@@ -21,6 +59,7 @@ class AssembleMetaSPAdes(sl.ContainerTask):
     # URL of the container
     container = "quay.io/fhcrc-microbiome/metaspades:v3.11.1--8"
 
+    @cache_target
     def out_fasta(self):
         # Output is an S3 object
         return sl.ContainerTargetInfo(
@@ -33,11 +72,8 @@ class AssembleMetaSPAdes(sl.ContainerTask):
 
     def run(self):
 
-        if self.output_folder.endswith("/") is False:
-            self.output_folder = self.output_folder + "/"
-
         self.ex(
-            command=" ".join([
+            command=shlex.join([
                 "run_metaspades.py",
                 "--input",
                 self.in_fastq().path,
@@ -62,15 +98,19 @@ class AnnotateProkka(sl.ContainerTask):
     # Sample name
     sample_name = sl.Parameter()
     # Output folder
-    output_folder = sl.Parameter()
-    # Number of threads to use
-    threads = sl.Parameter(default=4)
+    output_folder = FolderParameter()
+    # Number of threads to use (Prokka gains little from more than one)
+    threads = sl.Parameter(default=1)
     # Scratch directory
     temp_folder = sl.Parameter(default="/scratch")
+    # Folder (S3) with annotations keyed by the SHA256 of their input FASTA,
+    # sample name and container (leave empty to always run Prokka)
+    cache_folder = sl.Parameter(default="")
 
     # URL of the container
     container = "quay.io/fhcrc-microbiome/metaspades:v3.11.1--8"
 
+    @cache_target
     def out_gff(self):
         # Output is an S3 object
         return sl.ContainerTargetInfo(
@@ -81,6 +121,7 @@ class AnnotateProkka(sl.ContainerTask):
             )
         )
 
+    @cache_target
     def out_faa(self):
         # Output is an S3 object
         return sl.ContainerTargetInfo(
@@ -93,11 +134,26 @@ class AnnotateProkka(sl.ContainerTask):
 
     def run(self):
 
-        if self.output_folder.endswith("/") is False:
-            self.output_folder = self.output_folder + "/"
+        if self.cache_folder != "":
+            # Map each output to its location in the cache. The sample name is
+            # written into the outputs, so it is part of the key
+            cache_prefix = os.path.join(
+                self.cache_folder,
+                cache_key(self.in_fasta().path, self.sample_name, self.container)
+            )
+            cached_outputs = {
+                self.out_gff().path: cache_prefix + ".gff.gz",
+                self.out_faa().path: cache_prefix + ".fastp.gz",
+            }
+
+            # This assembly has already been annotated, reuse the results
+            if all(map(s3_path_exists, cached_outputs.values())):
+                for output_path, cache_path in cached_outputs.items():
+                    copy_s3_object(cache_path, output_path)
+                return
 
         self.ex(
-            command=" ".join([
+            command=shlex.join([
                 "run_prokka.py",
                 "--input",
                 self.in_fasta().path,
@@ -112,6 +168,10 @@ class AnnotateProkka(sl.ContainerTask):
             ])
         )
 
+        if self.cache_folder != "":
+            for output_path, cache_path in cached_outputs.items():
+                copy_s3_object(output_path, cache_path)
+
 
 class CheckM(sl.ContainerTask):
     # Input FASTP file of protein sequences
@@ -120,15 +180,22 @@ class CheckM(sl.ContainerTask):
     # Sample name
     sample_name = sl.Parameter()
     # Output folder
-    output_folder = sl.Parameter()
+    output_folder = FolderParameter()
     # Number of threads to use
     threads = sl.Parameter(default=4)
     # Scratch directory
     temp_folder = sl.Parameter(default="/scratch")
+    # Use the reduced reference tree, which fits in ~14Gb of memory
+    # (the full tree needs ~40Gb)
+    reduced_tree = luigi.BoolParameter(default=False)
+    # Folder (S3) with CheckM results keyed by the SHA256 of their input FAA,
+    # sample name, reference tree and container (leave empty to always run CheckM)
+    cache_folder = sl.Parameter(default="")
 
     # URL of the container
     container = "quay.io/fhcrc-microbiome/checkm:checkm-v1.0.11"
 
+    @cache_target
     def out_tsv(self):
         # Output is a tarball with all of the results
         return sl.ContainerTargetInfo(
@@ -141,8 +208,23 @@ class CheckM(sl.ContainerTask):
 
     def run(self):
 
-        if self.output_folder.endswith("/") is False:
-            self.output_folder = self.output_folder + "/"
+        if self.cache_folder != "":
+            # CheckM labels each bin with the name of its input file, which
+            # is the sample name, so that is part of the key
+            cache_path = os.path.join(
+                self.cache_folder,
+                cache_key(
+                    self.in_faa().path,
+                    self.sample_name,
+                    self.reduced_tree,
+                    self.container
+                ) + ".checkm.tsv"
+            )
+
+            # These genes have already been run through CheckM, reuse the results
+            if s3_path_exists(cache_path):
+                copy_s3_object(cache_path, self.out_tsv().path)
+                return
 
         input_targets = {
             "faa": self.in_faa()
@@ -152,35 +234,38 @@ class CheckM(sl.ContainerTask):
             "tsv": self.out_tsv()
         }
 
-        temp_dir = os.path.join(self.temp_folder, str(uuid.uuid4())[:8])
+        temp_dir = os.path.join(self.temp_folder, temp_dir_name())
+        reduced_tree_flag = "--reduced_tree " if self.reduced_tree else ""
+
+        commands = [
+            f"echo Making temp directory {temp_dir}",
+            # mkdir fails if the directory already exists
+            f"mkdir {temp_dir}",
+            "echo Making temp directories for input and output files",
+            f"mkdir {temp_dir}/checkm_input {temp_dir}/checkm_output",
+            # Decompress straight into the input directory, without an intermediate copy
+            "echo Decompressing gene FAA file into input directory",
+            # Use pigz when the image provides it, it decompresses on more than one core
+            f"if command -v pigz > /dev/null; then pigz -dc -p {self.threads} $faa; else gunzip -c $faa; fi > {temp_dir}/checkm_input/{self.sample_name}.fastp",
+            f"ls -lhtr {temp_dir}/checkm_input/",
+            "echo Running checkm",
+            f"checkm lineage_wf --genes -x fastp -t {self.threads} {reduced_tree_flag}--file {temp_dir}/checkm.tsv {temp_dir}/checkm_input/ {temp_dir}/checkm_output/",
+            "echo Finished running checkm",
+            "echo Copying results out of the container",
+            f"mv {temp_dir}/checkm.tsv $tsv",
+            "echo Deleting temporary folders",
+            f"rm -r {temp_dir}",
+        ]
 
         self.ex(
-            command="echo 'Checking to see if temp directory ({}) exists' && ".format(temp_dir) +
-                    "[ ! -d '{}' ] && ".format(temp_dir) +
-                    "echo Making temp directory {} && ".format(temp_dir) +
-                    "mkdir {} && ".format(temp_dir) +
-                    "echo Making temp directory for input files {}/checkm_input && ".format(temp_dir) +
-                    "mkdir {}/checkm_input && ".format(temp_dir) +
-                    "echo Making temp directory for output files {}/checkm_output && ".format(temp_dir) +
-                    "mkdir {}/checkm_output && ".format(temp_dir) +
-                    "echo Moving gene FAA file into input directory && " +
-                    "mv $faa " + "{}/checkm_input/ && ".format(temp_dir) +
-                    "echo Decompressing input file && " +
-                    "gunzip {}/checkm_input/* && ".format(temp_dir) +
-                    "ls -lhtr {}/checkm_input/ && ".format(temp_dir) +
-                    "echo Running checkm && " +
-                    "checkm lineage_wf --genes -x fastp -t {} --file {}/checkm.tsv {}/checkm_input/ {}/checkm_output/ && ".format(
-                        self.threads, temp_dir, temp_dir, temp_dir
-                    ) + 
-                    "echo Finished running checkm && " +
-                    "echo Copying results out of the container && " +
-                    "mv {}/checkm.tsv ".format(temp_dir) + "$tsv && " +
-                    "echo Deleting temporary folders && " +
-                    "rm -r {}".format(temp_dir),
+            command=" && ".join(commands),
             input_targets=input_targets,
             output_targets=output_targets
             )
 
+        if self.cache_folder != "":
+            copy_s3_object(self.out_tsv().path, cache_path)
+
 
 class IntegrateAssembliesTask(sl.ContainerTask):
     # Input FASTP files
@@ -195,13 +280,14 @@ class IntegrateAssembliesTask(sl.ContainerTask):
     # Output prefix
     output_prefix = sl.Parameter()
     # Output folder
-    output_folder = sl.Parameter()
+    output_folder = FolderParameter()
     # Scratch directory
     temp_folder = sl.Parameter(default="/scratch")
 
     # URL of the container
     container = "quay.io/fhcrc-microbiome/integrate-metagenomic-assemblies:v0.4"
 
+    @cache_target
     def out_daa(self):
         # DIAMOND database
         return sl.ContainerTargetInfo(
@@ -212,6 +298,7 @@ class IntegrateAssembliesTask(sl.ContainerTask):
             )
         )
 
+    @cache_target
     def out_json(self):
         # JSON summary of all data
         return sl.ContainerTargetInfo(
@@ -224,11 +311,8 @@ class IntegrateAssembliesTask(sl.ContainerTask):
 
     def run(self):
 
-        if self.output_folder.endswith("/") is False:
-            self.output_folder = self.output_folder + "/"
-
         self.ex(
-            command=" ".join([
+            command=shlex.join([
                 "integrate_assemblies.py",
                 "--gff-folder",
                 self.gff_folder,
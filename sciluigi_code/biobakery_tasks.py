@@ -1,5 +1,7 @@
 import os
+import shlex
 import sciluigi as sl
+from general_tasks import FolderParameter
 
 
 class HUMAnN2Task(sl.ContainerTask):
@@ -12,7 +14,7 @@ class HUMAnN2Task(sl.ContainerTask):
     # Sample name
     sample_name = sl.Parameter()
     # Output folder
-    output_folder = sl.Parameter()
+    output_folder = FolderParameter()
     # Number of threads to use
     threads = sl.Parameter(default=4)
     # Maximum amount of memory to use (gigabytes)
@@ -35,11 +37,8 @@ class HUMAnN2Task(sl.ContainerTask):
 
     def run(self):
 
-        if self.output_folder.endswith("/") is False:
-            self.output_folder = self.output_folder + "/"
-
         self.ex(
-            command=" ".join([
+            command=shlex.join([
                 "run.py",
                 "--input",
                 self.in_fastq().path,
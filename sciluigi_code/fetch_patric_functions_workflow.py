@@ -4,31 +4,152 @@
 import os
 import re
 import io
+import gzip
+import codecs
 import uuid
-import boto3
+import tempfile
 import argparse
 import pandas as pd
+import scipy.sparse
 import sciluigi as sl
 from urllib.request import urlopen
+from boto3.s3.transfer import TransferConfig
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from Bio.SeqIO.FastaIO import SimpleFastaParser
+from general_tasks import s3_client
+from general_tasks import split_s3_path
+from general_tasks import batch_job_name
+from general_tasks import batch_container_kwargs
+from general_tasks import sciluigi_cmdline_args
 
 
+# Headers of 16S transcripts contain " 16S " or " SSU "
+HEADER_16S = re.compile(' (?:16S|SSU) ')
+
 def read_tsv_from_s3_as_dataframe(bucket_name, key_name, sep="\t"):
-    s3 = boto3.client('s3')
+    s3 = s3_client()
     retr = s3.get_object(Bucket=bucket_name, Key=key_name)
 
     bytestream = io.BytesIO(retr['Body'].read())
     return pd.read_table(bytestream, sep=sep)
 
 
-def read_fasta_from_s3(bucket_name, key_name, sep="\t"):
-    s3 = boto3.client('s3')
+def read_tsv_column_counts_from_s3(bucket_name, key_name, col_name, sep="\t"):
+    """Count the number of times each value appears in a single column of a table on S3."""
+    s3 = s3_client()
     retr = s3.get_object(Bucket=bucket_name, Key=key_name)
 
-    for header, seq in SimpleFastaParser(io.StringIO(retr['Body'].read().decode('utf-8'))):
+    # Only parse the one column, and count it as categories rather than strings
+    bytestream = io.BytesIO(retr['Body'].read())
+    return pd.read_csv(
+        bytestream,
+        sep=sep,
+        usecols=[col_name],
+        dtype={col_name: "category"}
+    )[col_name].value_counts()
+
+
+def iter_s3_body_lines(body, chunk_size=1024 * 1024):
+    """Decode the lines of an S3 object as it is downloaded, in large blocks rather than line by line."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    partial_line = ""
+
+    for chunk in body.iter_chunks(chunk_size):
+        lines = (partial_line + decoder.decode(chunk)).split("\n")
+        # The last line may carry on into the next chunk
+        partial_line = lines.pop()
+        for line in lines:
+            yield line + "\n"
+
+    partial_line += decoder.decode(b"", final=True)
+    if partial_line:
+        yield partial_line
+
+
+def filtered_fasta_parser(handle, keep_header):
+    """Parse a FASTA like SimpleFastaParser, skipping the records whose header is not kept."""
+    header = None
+    seq_lines = []
+
+    for line in handle:
+        if line.startswith(">"):
+            if header is not None:
+                yield header, "".join(seq_lines).replace(" ", "").replace("\r", "")
+            header = line[1:].rstrip()
+            # Lines of sequence are only saved for the records that are kept
+            if not keep_header(header):
+                header = None
+            seq_lines = []
+        elif header is not None:
+            seq_lines.append(line.rstrip())
+
+    if header is not None:
+        yield header, "".join(seq_lines).replace(" ", "").replace("\r", "")
+
+
+def read_fasta_from_s3(bucket_name, key_name, sep="\t", keep_header=None):
+    s3 = s3_client()
+    retr = s3.get_object(Bucket=bucket_name, Key=key_name)
+
+    # Decode and parse the body as it is downloaded, rather than holding the whole file in memory
+    handle = iter_s3_body_lines(retr['Body'])
+
+    if keep_header is None:
+        parser = SimpleFastaParser(handle)
+    else:
+        parser = filtered_fasta_parser(handle, keep_header)
+
+    for header, seq in parser:
         yield header, seq
 
 
+@contextmanager
+def open_gzip_for_s3(s3_path):
+    """Write to a compressed local file, which is uploaded to S3 once it is closed."""
+    bucket, key = split_s3_path(s3_path)
+
+    with tempfile.TemporaryFile() as fo:
+        with gzip.open(fo, "wt") as gz:
+            yield gz
+
+        # upload_fileobj sends large files as a multipart upload
+        fo.seek(0)
+        s3_client().upload_fileobj(fo, bucket, key)
+
+
+def read_16S_from_s3(transcripts_path):
+    """Get the ID and sequence of all 16S transcripts in a FASTA on S3."""
+    bucket, transcript_key = split_s3_path(transcripts_path)
+
+    return [
+        (header.split(" ", 1)[0], seq)
+        for header, seq in read_fasta_from_s3(
+            bucket,
+            transcript_key,
+            keep_header=HEADER_16S.search
+        )
+    ]
+
+
+def read_genome_annotations(transcripts_path, annotations_path):
+    """Get the 16S transcripts and functional copy numbers for a single genome."""
+
+    # Get the 16S transcripts from the FASTA
+    transcripts = read_16S_from_s3(transcripts_path)
+
+    # Get the annotations for this genome
+    bucket, annotation_key = split_s3_path(annotations_path)
+
+    # Make a copy number vector
+    functional_copy_numbers = read_tsv_column_counts_from_s3(
+        bucket, annotation_key, "product"
+    ).to_dict()
+
+    return transcripts, functional_copy_numbers
+
+
 class TransferFTPtoS3(sl.ContainerTask):
     """Transfer a file from an FTP server to an AWS S3 bucket."""
     # FTP path
@@ -58,112 +179,103 @@ class TransferFTPtoS3(sl.ContainerTask):
         )
 
 
-class Extract16S(sl.ContainerTask):
-    """Extract all of the 16S transcripts from a list of S3 FASTA files."""
+class Extract16SAndAnnotations(sl.ContainerTask):
+    """Extract all of the 16S transcripts, and make a TSV of annotations keyed by the 16S accession names."""
     # Input files
     in_fastas = None
-    # Folder with all of the transcripts in subfolders
-    s3_parent_folder = sl.Parameter()
+    in_annotations = None
+
     # Single flat file with all of the transcripts
-    s3_url = sl.Parameter()
-    # Temporary folder to use for downloading data inside the Docker container
-    temp_folder = sl.Parameter()
+    fasta_s3_url = sl.Parameter()
+    # Single flat file with all of the annotations
+    tsv_s3_url = sl.Parameter()
+    # Number of genomes to fetch from S3 at the same time
+    threads = sl.Parameter(default=16)
 
-    # Container with wget
+    # Everything is read and written with boto3 in run(), so this container is never started
     container = "quay.io/fhcrc-microbiome/python:python-v0.1"
 
-    def out_file(self):
+    def out_fasta(self):
         # File on S3
         return sl.ContainerTargetInfo(
             self,
-            self.s3_url
+            self.fasta_s3_url
         )
 
-    def run(self):
-
-        # Save all of the transcripts with " 16S " or " SSU " in the header
-        output = {}
-
-        for genome_transcripts in self.in_fastas:
-
-            # Get the transcript names from the FASTA
-            bucket, transcript_key = genome_transcripts(
-            ).path[5:].split("/", 1)
-            
-            for header, seq in read_fasta_from_s3(bucket, transcript_key):
-                if " 16S " in header or " SSU " in header:
-                    header = header.split(" ", 1)[0]
-                    assert header not in output, "Duplicated transcript ID, stopping ({})".format(header)
-
-                    output[header] = seq
-
-        # Now write it to S3
-        output_bucket, output_key = self.out_file().path[5:].split("/", 1)
-        fasta_buffer = io.StringIO()
-        for header, seq in output.items():
-            fasta_buffer.write(">{}\n{}\n".format(header, seq))
-
-        s3 = boto3.resource('s3')
-        s3.Object(output_bucket, output_key).put(Body=fasta_buffer.getvalue())
-
-
-class ExtractAnnotations(sl.Task):
-    """Extract all of annotations and make a TSV keyed by the 16S accession names."""
-    # Input files
-    in_fastas = None
-    in_annotations = None
-
-    # Single flat file with all of the annotations
-    s3_url = sl.Parameter()
-
-    # Temporary folder to use for downloading data inside the Docker container
-    temp_folder = sl.Parameter()
-
-    def out_file(self):
+    def out_tsv(self):
         # File on S3
         return sl.ContainerTargetInfo(
             self,
-            self.s3_url
+            self.tsv_s3_url
         )
 
     def run(self):
 
-        # The final output is going to be a DataFrame with rows as 16S accessions and columns as annotations, values are copy numbers
-        output = {}
-
-        for genome_id, genome_transcripts in self.in_fastas.items():
-            # Make sure that we also have an annotation for this genome
-            assert genome_id in self.in_annotations
-
-            # Get the transcript names from the FASTA
-            bucket, transcript_key = genome_transcripts().path[5:].split("/", 1)
-            transcript_ids = [
-                header.split(" ", 1)[0]
-                for header, seq in read_fasta_from_s3(bucket, transcript_key)
-                if " 16S " in header or " SSU " in header
-            ]
-
-            # Get the annotations for this genome
-            bucket, annotation_key = self.in_annotations[genome_id]().path[5:].split("/", 1)
-            genome_annotations = read_tsv_from_s3_as_dataframe(bucket, annotation_key)
+        # Save all of the transcripts with " 16S " or " SSU " in the header
+        transcripts = []
+        transcript_seqs = []
+
+        # The annotations are going to be a DataFrame with rows as 16S accessions and columns as annotations, values are copy numbers
+        # Most of those copy numbers are zero, so only keep the others as (row, column, value)
+        product_index = {}
+        rows, cols, vals = [], [], []
+
+        # Make sure that we also have an annotation for every genome
+        missing_annotations = set(self.in_fastas) - set(self.in_annotations)
+        if len(missing_annotations) > 0:
+            raise ValueError("No annotations found for {}".format(
+                ", ".join(sorted(missing_annotations))
+            ))
+
+        # Each genome is two separate S3 requests, so fetch several genomes at once.
+        # Each FASTA is only read once, for both the transcripts and the annotations.
+        with ThreadPoolExecutor(max_workers=int(self.threads)) as executor:
+            genome_annotations = executor.map(
+                read_genome_annotations,
+                [genome_transcripts().path for genome_transcripts in self.in_fastas.values()],
+                [self.in_annotations[genome_id]().path for genome_id in self.in_fastas]
+            )
 
-            # Make a copy number vector
-            functional_copy_numbers = genome_annotations["product"].value_counts().to_dict()
-            
-            # Add the annotations to the list
-            for transcript in transcript_ids:
-                assert transcript not in output, "Transcript found twice, stopping ({})".format(transcript)
-                output[transcript] = functional_copy_numbers
+            for genome_transcripts, functional_copy_numbers in genome_annotations:
+                # Add the annotations to the list
+                for transcript, seq in genome_transcripts:
+                    row = len(transcripts)
+                    transcripts.append(transcript)
+                    transcript_seqs.append(seq)
+
+                    for product, copy_number in functional_copy_numbers.items():
+                        rows.append(row)
+                        cols.append(product_index.setdefault(product, len(product_index)))
+                        vals.append(copy_number)
+
+        # Check for duplicates once, rather than for every transcript as it is added
+        if len(set(transcripts)) != len(transcripts):
+            raise ValueError("Transcript found twice, stopping ({})".format(
+                ", ".join(
+                    transcript
+                    for transcript, n in Counter(transcripts).items()
+                    if n > 1
+                )
+            ))
+
+        # Make a single DataFrame, without filling in all of the zeros
+        output = pd.DataFrame.sparse.from_spmatrix(
+            scipy.sparse.coo_matrix(
+                (vals, (rows, cols)),
+                shape=(len(transcripts), len(product_index)),
+                dtype="int32"
+            ),
+            index=transcripts,
+            columns=list(product_index)
+        )
 
-        # Make a single DataFrame
-        output = pd.DataFrame(output).fillna(0).T
+        # Now write both files to S3
+        with open_gzip_for_s3(self.out_fasta().path) as fasta_out:
+            for header, seq in zip(transcripts, transcript_seqs):
+                fasta_out.write(">{}\n{}\n".format(header, seq))
 
-        # Now write it to S3
-        output_bucket, output_key = self.out_file().path[5:].split("/", 1)
-        tsv_buffer = io.StringIO()
-        output.to_csv(tsv_buffer, sep='\t')
-        s3 = boto3.resource('s3')
-        s3.Object(output_bucket, output_key).put(Body=tsv_buffer.getvalue())
+        with open_gzip_for_s3(self.out_tsv().path) as tsv_out:
+            output.to_csv(tsv_out, sep='\t')
 
 
 class FetchPatricFunctions(sl.WorkflowTask):
@@ -181,10 +293,7 @@ class FetchPatricFunctions(sl.WorkflowTask):
         assert self.s3_folder.startswith("s3://")
 
         # Parse the bucket and key for the s3 folder for all results
-        s3_bucket, s3_prefix = self.s3_folder[5:].split("/", 1)
-
-        # Connect to S3
-        s3 = boto3.resource('s3')
+        s3_bucket, s3_prefix = split_s3_path(self.s3_folder)
 
         # 1. Get the summary of all genomes
         genome_metadata_fp = os.path.join(s3_prefix, "patric_genome_metadata.tsv")
@@ -195,16 +304,28 @@ class FetchPatricFunctions(sl.WorkflowTask):
         ))
 
         with urlopen("ftp://ftp.patricbrc.org/RELEASE_NOTES/genome_metadata") as fi:
-            s3.Bucket(
-                s3_bucket
-            ).put_object(
-                Key=genome_metadata_fp, 
-                Body=fi.read()
+            # Stream the download into S3 in 8MB parts, instead of reading the whole file first
+            s3_client().upload_fileobj(
+                fi,
+                s3_bucket,
+                genome_metadata_fp,
+                Config=TransferConfig(
+                    multipart_chunksize=8 * 1024 * 1024,
+                    max_concurrency=8
+                )
             )
 
         # Now read in all of that information as a table
         genome_metadata = read_tsv_from_s3_as_dataframe(s3_bucket, genome_metadata_fp, sep="\t")
 
+        # Every job runs with the same small amount of resources
+        container_kwargs = batch_container_kwargs(
+            self,
+            vcpu=1,
+            mem=1000,
+            aws_batch_job_poll_sec=120
+        )
+
         # 2. Fetch the transcripts and annotation files for every genome
         fetch_transcripts_tasks = {}
         fetch_annotation_tasks = {}
@@ -226,14 +347,8 @@ class FetchPatricFunctions(sl.WorkflowTask):
                         "annotation.tsv"
                     ),
                     containerinfo=sl.ContainerInfo(
-                        vcpu=1,
-                        mem=1000,
-                        engine=self.engine,
-                        aws_batch_job_poll_sec=120,
-                        aws_jobRoleArn=self.aws_job_role_arn,
-                        aws_batch_job_queue=self.aws_batch_job_queue,
-                        aws_batch_job_prefix=re.sub(
-                            '[^a-zA-Z0-9-_]', '_',
+                        **container_kwargs,
+                        aws_batch_job_prefix=batch_job_name(
                             "fetch_patric_annotations_{}".format(genome_accession)
                         )
                     )
@@ -256,14 +371,8 @@ class FetchPatricFunctions(sl.WorkflowTask):
                         "transcripts.frn"
                     ),
                     containerinfo=sl.ContainerInfo(
-                        vcpu=1,
-                        mem=1000,
-                        engine=self.engine,
-                        aws_batch_job_poll_sec=120,
-                        aws_jobRoleArn=self.aws_job_role_arn,
-                        aws_batch_job_queue=self.aws_batch_job_queue,
-                        aws_batch_job_prefix=re.sub(
-                            '[^a-zA-Z0-9-_]', '_',
+                        **container_kwargs,
+                        aws_batch_job_prefix=batch_job_name(
                             "fetch_patric_transcripts_{}".format(
                                 genome_accession)
                         )
@@ -272,57 +381,28 @@ class FetchPatricFunctions(sl.WorkflowTask):
                 for suffix in ["PATRIC.frn", "RefSeq.frn"]
             ]
 
-        # 3. Make a flat file for the 16S records
-
-        extract_all_16S = self.new_task(
-            "extract_all_16S",
-            Extract16S,
-            s3_parent_folder=self.s3_folder,
-            s3_url=os.path.join(self.s3_folder, "transcripts.fasta"),
-            temp_folder=self.temp_folder,
-            containerinfo=sl.ContainerInfo(
-                vcpu=1,
-                mem=1000,
-                engine=self.engine,
-                aws_batch_job_poll_sec=120,
-                aws_jobRoleArn=self.aws_job_role_arn,
-                aws_batch_job_queue=self.aws_batch_job_queue,
-                aws_batch_job_prefix="extract_all_16s"
-            )
-        )
-
-        extract_all_16S.in_fastas = [
-            genome_transcript[0].out_file for genome_transcript in fetch_transcripts_tasks.values()
-        ]
-
-        # 4. Make a flat file for the annotations
-        extract_all_annotations = self.new_task(
-            "extract_all_annotations",
-            ExtractAnnotations,
-            s3_parent_folder=self.s3_folder,
-            s3_url=os.path.join(self.s3_folder, "annotations.tsv"),
-            temp_folder=self.temp_folder,
+        # 3. Make a flat file for the 16S records, and another for their annotations
+        extract_16S_and_annotations = self.new_task(
+            "extract_16S_and_annotations",
+            Extract16SAndAnnotations,
+            fasta_s3_url=os.path.join(self.s3_folder, "transcripts.fasta.gz"),
+            tsv_s3_url=os.path.join(self.s3_folder, "annotations.tsv.gz"),
             containerinfo=sl.ContainerInfo(
-                vcpu=1,
-                mem=1000,
-                engine=self.engine,
-                aws_batch_job_poll_sec=120,
-                aws_jobRoleArn=self.aws_job_role_arn,
-                aws_batch_job_queue=self.aws_batch_job_queue,
-                aws_batch_job_prefix="extract_all_annotations"
+                **container_kwargs,
+                aws_batch_job_prefix="extract_16s_and_annotations"
             )
         )
 
-        extract_all_annotations.in_fastas = {
+        extract_16S_and_annotations.in_fastas = {
             genome_id: genome_transcript[0].out_file
             for genome_id, genome_transcript in fetch_transcripts_tasks.items()
         }
-        extract_all_annotations.in_annotations = {
+        extract_16S_and_annotations.in_annotations = {
             genome_id: genome_annotation[0].out_file
             for genome_id, genome_annotation in fetch_annotation_tasks.items()
         }
 
-        return extract_all_16S, extract_all_annotations
+        return extract_16S_and_annotations
 
 
 if __name__ == "__main__":
@@ -366,10 +446,5 @@ if __name__ == "__main__":
 
     sl.run(
         main_task_cls=FetchPatricFunctions,
-        cmdline_args=[
-            "--{}={}".format(
-                k.replace("_", "-"),
-                v)
-            for k, v in args.__dict__.items()
-        ]
+        cmdline_args=sciluigi_cmdline_args(args)
     )
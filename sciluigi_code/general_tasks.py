@@ -1,5 +1,188 @@
 import os
+import csv
+import re
+import zlib
+import boto3
+import hashlib
+import threading
 import sciluigi as sl
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Characters which cannot be used in the name of an AWS Batch job
+JOB_NAME_INVALID_CHARS = re.compile('[^a-zA-Z0-9-_]')
+
+
+def batch_job_name(name):
+    """Replace the characters which cannot be used in the name of an AWS Batch job."""
+    return JOB_NAME_INVALID_CHARS.sub('_', name)
+
+
+def docker_scratch_mount(temp_folder):
+    """Mount the scratch folder of the host at /docker_scratch in the container."""
+    return {
+        "/docker_scratch": {
+            "bind": temp_folder,
+            "mode": "rw"
+        }
+    }
+
+
+def batch_container_kwargs(workflow, **kwargs):
+    """Execution settings shared by every job a workflow submits, plus any overrides."""
+    container_kwargs = dict(
+        engine=workflow.engine,
+        aws_s3_scratch_loc=workflow.aws_s3_scratch_loc,
+        aws_jobRoleArn=workflow.aws_job_role_arn,
+        aws_batch_job_queue=workflow.aws_batch_job_queue,
+    )
+    container_kwargs.update(kwargs)
+    return container_kwargs
+
+
+def sciluigi_cmdline_args(args):
+    """Turn the parsed arguments of a workflow script into the command line for luigi.
+
+    Options which were not given are left out, instead of being passed as "None".
+    luigi takes boolean parameters as bare flags, so only those which are set are passed.
+    """
+    cmdline_args = []
+    for k, v in vars(args).items():
+        if v is None or v is False:
+            continue
+        flag = "--{}".format(k.replace("_", "-"))
+        if v is True:
+            cmdline_args.append(flag)
+        else:
+            cmdline_args.append("{}={}".format(flag, v))
+    return cmdline_args
+
+
+def read_metadata(metadata_fp, sep, sample_column_name, input_column_name):
+    """Read the (sample name, input path) pairs from a metadata sheet.
+
+    Both columns must be present, and every sample name and input path must be unique.
+    """
+    # Accept the escaped tab which is easy to type on the command line
+    if sep in ["\\t", "<tab>"]:
+        sep = "\t"
+    assert len(sep) == 1, \
+        "Metadata separator must be a single character, not {}".format(repr(sep))
+
+    # Ignore the BOM which Excel writes at the start of UTF-8 files
+    with open(metadata_fp, encoding="utf-8-sig", newline="") as handle:
+        reader = csv.DictReader(handle, delimiter=sep)
+        for col_name in [sample_column_name, input_column_name]:
+            assert col_name in (reader.fieldnames or []), "{} not found in {}".format(
+                col_name, metadata_fp
+            )
+        rows = [
+            (r[sample_column_name], r[input_column_name])
+            for r in reader
+        ]
+
+    for col_name, values in zip([sample_column_name, input_column_name], zip(*rows)):
+        assert len(set(values)) == len(values), "{} has duplicate values".format(col_name)
+
+    return rows
+
+
+# A single S3 client is shared by every thread (creating one is not thread-safe, using one is),
+# keyed by PID so that forked luigi workers don't share the connections of their parent
+_s3_clients = {}
+_s3_client_lock = threading.Lock()
+
+
+def s3_client():
+    """Get the S3 client for this process."""
+    with _s3_client_lock:
+        if os.getpid() not in _s3_clients:
+            _s3_clients[os.getpid()] = boto3.session.Session().client(
+                's3',
+                # Keep enough connections open for all of the threads sharing the client
+                config=Config(max_pool_connections=64, retries={"mode": "standard"})
+            )
+        return _s3_clients[os.getpid()]
+
+
+def split_s3_path(path):
+    """Split an S3 URL into the bucket and the key."""
+    assert path.startswith("s3://"), "Not an S3 path: {}".format(path)
+    return path[5:].split("/", 1)
+
+
+def s3_path_exists(path):
+    """Check whether an object exists in S3."""
+    bucket, key = split_s3_path(path)
+    try:
+        s3_client().head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+            return False
+        raise
+    return True
+
+
+def copy_s3_object(source_path, dest_path):
+    """Copy an object from one location in S3 to another."""
+    source_bucket, source_key = split_s3_path(source_path)
+    dest_bucket, dest_key = split_s3_path(dest_path)
+    s3_client().copy(
+        {"Bucket": source_bucket, "Key": source_key},
+        dest_bucket,
+        dest_key
+    )
+
+
+def s3_sha256(path, chunk_size=8 * 1024 * 1024, gunzip=False):
+    """Get the SHA256 of an object in S3, reading it in chunks.
+
+    With gunzip=True a gzipped object is hashed by its uncompressed contents,
+    so that the checksum doesn't change with the timestamp in the gzip header.
+    """
+    bucket, key = split_s3_path(path)
+    retr = s3_client().get_object(Bucket=bucket, Key=key)
+
+    checksum = hashlib.sha256()
+    decompressor = None
+    for ix, chunk in enumerate(retr["Body"].iter_chunks(chunk_size)):
+        if ix == 0 and gunzip and chunk[:2] == b"\x1f\x8b":
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        if decompressor is not None:
+            data = decompressor.decompress(chunk)
+            # Concatenated gzip files have more than one member
+            while decompressor.eof and decompressor.unused_data:
+                unused_data = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                data += decompressor.decompress(unused_data)
+            chunk = data
+        checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class FolderParameter(sl.Parameter):
+    """Parameter for a folder, which always ends with a trailing slash."""
+
+    def normalize(self, x):
+        if x.endswith("/"):
+            return x
+        return x + "/"
+
+
+class CachedCompleteMixin:
+    """Only check the outputs of a task in S3 until they are found to exist.
+
+    luigi asks whether a task is complete several times over a run (while
+    building the graph, when scheduling, and again after it runs), and every
+    call sends a request to S3 for each output. Outputs are never removed while
+    the workflow is running, so once a task is complete that answer is kept.
+    """
+
+    def complete(self):
+        if not self.__dict__.get("_cached_complete"):
+            self.__dict__["_cached_complete"] = super().complete()
+        return self.__dict__["_cached_complete"]
+
 
 class LoadFile(sl.ExternalTask):
     path = sl.Parameter()
@@ -46,6 +229,63 @@ class FastqpTask(sl.ContainerTask):
         )
 
 
+class BinpackedFastqpTask(sl.ContainerTask):
+    """Run fastqp for a batch of samples inside a single container."""
+
+    # Input: dict of FASTQ files, keyed by sample name
+    in_fastq_dict = None
+
+    # Folder for the summaries, one per sample
+    summary_folder = sl.Parameter()
+
+    input_mount_point = sl.Parameter(default="/mnt/input/")
+    output_mount_point = sl.Parameter(default="/mnt/output/")
+
+    # URL of the container
+    container = "quay.io/fhcrc-microbiome/fastqp:fastqp-v0.2"
+
+    def out_summaries(self):
+        return {
+            sample_name: sl.ContainerTargetInfo(
+                self,
+                os.path.join(
+                    self.summary_folder,
+                    sample_name + ".fastqp.tsv"
+                )
+            )
+            for sample_name in self.in_fastq_dict
+        }
+
+    def run(self):
+
+        # Give every sample its own pair of template variables
+        sample_names = sorted(self.in_fastq_dict)
+
+        input_targets = {
+            "fastq_{}".format(ix): self.in_fastq_dict[sample_name]()
+            for ix, sample_name in enumerate(sample_names)
+        }
+
+        summaries = self.out_summaries()
+        output_targets = {
+            "summary_file_{}".format(ix): summaries[sample_name]
+            for ix, sample_name in enumerate(sample_names)
+        }
+
+        # Every FASTQ in the batch is staged into this container, so keep the
+        # batches small (see fastqp_batch_size in AssembleFamliWorkflow)
+        self.ex(
+            command=" && ".join([
+                "fastqp -e $summary_file_{ix} $fastq_{ix}".format(ix=ix)
+                for ix in range(len(sample_names))
+            ]),
+            input_targets=input_targets,
+            output_targets=output_targets,
+            input_mount_point=self.input_mount_point,
+            output_mount_point=self.output_mount_point,
+        )
+
+
 class AlignFastqTask(sl.ContainerTask):
 
     # Inputs: FASTQ and reference database
@@ -105,7 +345,7 @@ class AlignFastqTask(sl.ContainerTask):
         )
 
 
-class FAMLITask(sl.ContainerTask):
+class FAMLITask(CachedCompleteMixin, sl.ContainerTask):
 
     # Inputs: FASTQ and reference database
     in_fastq = None
@@ -115,7 +355,7 @@ class FAMLITask(sl.ContainerTask):
     sample_name = sl.Parameter()
 
     # Parameter: Output folder
-    output_folder = sl.Parameter()
+    output_folder = FolderParameter()
 
     # Parameter: Number of threads for alignment
     threads = sl.Parameter()
@@ -141,9 +381,6 @@ class FAMLITask(sl.ContainerTask):
 
     def run(self):
 
-        if self.output_folder[-1] != '/':
-            self.output_folder += '/'
-
         self.ex(
             command=" ".join([
                 "famli",
@@ -2,13 +2,16 @@
 """Analyze a set of FASTQ files with HUMAnN2."""
 
 import os
-import re
 import uuid
 import argparse
-import pandas as pd
 import sciluigi as sl
 from general_tasks import LoadFile
+from general_tasks import read_metadata
 from general_tasks import FastqpTask
+from general_tasks import batch_job_name
+from general_tasks import batch_container_kwargs
+from general_tasks import docker_scratch_mount
+from general_tasks import sciluigi_cmdline_args
 from biobakery_tasks import HUMAnN2Task
 
 
@@ -31,14 +34,25 @@ class HUMAnN2Workflow(sl.WorkflowTask):
     def workflow(self):
 
         # Read in the metadata sheet
-        metadata = pd.read_table(self.metadata_fp, sep=self.metadata_fp_sep)
-
-        for col_name in [self.input_column_name, self.sample_column_name]:
-            assert col_name in metadata.columns, "{} not found in {}".format(
-                col_name, self.metadata_fp
-            )
-            # Make sure that all samples and files are unique
-            assert metadata[col_name].unique().shape[0] == metadata.shape[0]
+        sample_rows = read_metadata(
+            self.metadata_fp,
+            self.metadata_fp_sep,
+            self.sample_column_name,
+            self.input_column_name
+        )
+
+        container_kwargs = batch_container_kwargs(self)
+        scratch_mount = docker_scratch_mount(self.temp_folder)
+        # HUMAnN2 also reads the reference databases from the host
+        humann2_mounts = {
+            **scratch_mount,
+            "/refdbs": {
+                "bind": "/refdbs",
+                "mode": "ro"
+            }
+        }
+        humann2_threads = int(self.humann2_threads)
+        humann2_mem = int(self.humann2_mem)
 
         # Keep track of the jobs for each step, for each sample
         tasks_load_inputs = {}
@@ -46,14 +60,10 @@ class HUMAnN2Workflow(sl.WorkflowTask):
         tasks_humann = {}
 
         # Iterate over all of the rows of samples
-        for ix, r in metadata.iterrows():
-
-            # Get the sample name and the file location
-            sample_name = r[self.sample_column_name]
-            input_path = r[self.input_column_name]
+        for sample_name, input_path in sample_rows:
 
             # Make a UUID to isolate temp files for this task from any others
-            task_uuid = str(uuid.uuid4())[:8]
+            task_uuid = uuid.uuid4().hex[:8]
 
             # 1. LOAD THE INPUT FILES
 
@@ -79,20 +89,11 @@ class HUMAnN2Workflow(sl.WorkflowTask):
                 containerinfo=sl.ContainerInfo(
                     vcpu=1,
                     mem=10000,
-                    engine=self.engine,
-                    aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                    aws_jobRoleArn=self.aws_job_role_arn,
-                    aws_batch_job_queue=self.aws_batch_job_queue,
-                    aws_batch_job_prefix=re.sub(
-                        '[^a-zA-Z0-9-_]', '_',
+                    **container_kwargs,
+                    aws_batch_job_prefix=batch_job_name(
                         "fastqp_{}".format(sample_name)
                     ),
-                    mounts={
-                        "/docker_scratch": {
-                            "bind": self.temp_folder,
-                            "mode": "rw"
-                        }
-                    }
+                    mounts=scratch_mount
                 )
             )
 
@@ -109,26 +110,13 @@ class HUMAnN2Workflow(sl.WorkflowTask):
                 ref_db=self.humann2_ref_db,
                 temp_folder=self.temp_folder,
                 containerinfo=sl.ContainerInfo(
-                    vcpu=int(self.humann2_threads),
-                    mem=int(self.humann2_mem),
-                    engine=self.engine,
-                    aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                    aws_jobRoleArn=self.aws_job_role_arn,
-                    aws_batch_job_queue=self.aws_batch_job_queue,
-                    aws_batch_job_prefix=re.sub(
-                        '[^a-zA-Z0-9-_]', '_',
+                    vcpu=humann2_threads,
+                    mem=humann2_mem,
+                    **container_kwargs,
+                    aws_batch_job_prefix=batch_job_name(
                         "humann2_{}".format(sample_name)
                     ),
-                    mounts={
-                        "/docker_scratch": {
-                            "bind": self.temp_folder,
-                            "mode": "rw"
-                        },
-                        "/refdbs": {
-                            "bind": "/refdbs",
-                            "mode": "ro"
-                        }
-                    }
+                    mounts=humann2_mounts
                 )
             )
 
@@ -239,10 +227,5 @@ if __name__ == "__main__":
 
     sl.run(
         main_task_cls = HUMAnN2Workflow,
-        cmdline_args=[
-            "--{}={}".format(
-                k.replace("_", "-"),
-                v)
-            for k, v in args.__dict__.items()
-        ]
+        cmdline_args=sciluigi_cmdline_args(args)
     )
@@ -2,13 +2,15 @@
 """Assemble a set of FASTQ files, combine the assemblies, and align with FAMLI."""
 
 import os
-import re
-import uuid
 import argparse
-import pandas as pd
 import sciluigi as sl
 from general_tasks import LoadFile
+from general_tasks import read_metadata
 from general_tasks import FAMLITask
+from general_tasks import batch_job_name
+from general_tasks import batch_container_kwargs
+from general_tasks import docker_scratch_mount
+from general_tasks import sciluigi_cmdline_args
 from sra_tasks import ImportSRAFastq
 
 
@@ -34,50 +36,53 @@ class MapFamliWorkflow(sl.WorkflowTask):
     def workflow(self):
 
         # Make sure the project name is alphanumeric
-        assert all([
-            s.isalnum() or s == "_"
-            for s in self.project_name
-        ]), "Project name must be alphanumeric"
+        assert self.project_name.replace("_", "").isalnum(), \
+            "Project name must be alphanumeric"
 
         # Data can come from either SRA or S3
         assert self.input_location in ["SRA", "S3"]
 
         # Read in the metadata sheet
-        metadata = pd.read_table(self.metadata_fp, sep=self.metadata_fp_sep)
-
-        for col_name in [self.input_column_name, self.sample_column_name]:
-            assert col_name in metadata.columns, "{} not found in {}".format(
-                col_name, self.metadata_fp
-            )
-            # Make sure that all samples and files are unique
-            assert metadata[col_name].unique().shape[0] == metadata.shape[0]
+        sample_rows = read_metadata(
+            self.metadata_fp,
+            self.metadata_fp_sep,
+            self.sample_column_name,
+            self.input_column_name
+        )
+
+        # 0. LOAD THE DATABASE (shared by every sample)
+        tasks_load_db = self.new_task(
+            "load_db_from_s3",
+            LoadFile,
+            path=self.famli_db_location
+        )
+
+        container_kwargs = batch_container_kwargs(
+            self,
+            aws_batch_job_poll_sec=120,
+            mounts=docker_scratch_mount(self.temp_folder)
+        )
+        famli_threads = int(self.famli_threads)
+        famli_mem = int(self.famli_mem)
+
+        # All of the FAMLI outputs go in the same folder
+        famli_output_folder = os.path.join(
+            self.base_s3_folder,
+            self.output_folder
+        )
 
         # Keep track of the jobs for each step, for each sample
         tasks_load_inputs = {}
         tasks_famli = {}
 
         # Iterate over all of the rows of samples
-        for _, r in metadata.iterrows():
-
-            # Get the sample name and the file location
-            sample_name = r[self.sample_column_name]
-            input_path = r[self.input_column_name]
-
-            # Make a UUID to isolate temp files for this task from any others
-            task_uuid = str(uuid.uuid4())[:8]
-
-            # 0. LOAD THE DATABASE
-            tasks_load_db = self.new_task(
-                "load_db_from_s3",
-                LoadFile,
-                path=self.famli_db_location
-            )
+        for sample_name, input_path in sample_rows:
 
             # 1. LOAD THE INPUT FILES
             
             if self.input_location == "S3":
                 tasks_load_inputs[sample_name] = self.new_task(
-                    "load_from_s3_{}".format(sample_name),
+                    f"load_from_s3_{sample_name}",
                     LoadFile,
                     path=input_path
                 )
@@ -85,32 +90,17 @@ class MapFamliWorkflow(sl.WorkflowTask):
                 assert input_path.startswith("SRR"), input_path
 
                 tasks_load_inputs[sample_name] = self.new_task(
-                    "download_from_SRA_{}".format(sample_name),
+                    f"download_from_SRA_{sample_name}",
                     ImportSRAFastq,
                     sra_accession=input_path,
                     base_s3_folder=self.base_s3_folder,
-                    input_mount_point="/scratch/{}_get_sra/input/".format(
-                        task_uuid),
-                    output_mount_point="/scratch/{}_get_sra/output/".format(
-                        task_uuid),
                     containerinfo=sl.ContainerInfo(
                         vcpu=1,
                         mem=32000,
-                        engine=self.engine,
-                        aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                        aws_batch_job_poll_sec=120,
-                        aws_jobRoleArn=self.aws_job_role_arn,
-                        aws_batch_job_queue=self.aws_batch_job_queue,
-                        aws_batch_job_prefix=re.sub(
-                            '[^a-zA-Z0-9-_]', '_',
-                            "get_sra_{}".format(sample_name)
-                        ),
-                        mounts={
-                            "/docker_scratch": {
-                                "bind": self.temp_folder,
-                                "mode": "rw"
-                            }
-                        }
+                        **container_kwargs,
+                        aws_batch_job_prefix=batch_job_name(
+                            f"get_sra_{sample_name}"
+                        )
                     )
                 )
             else:
@@ -119,30 +109,17 @@ class MapFamliWorkflow(sl.WorkflowTask):
             # 2. ALIGN AGAINST THE DATABASE USING FAMLI
 
             tasks_famli[sample_name] = self.new_task(
-                "famli_{}".format(sample_name),
+                f"famli_{sample_name}",
                 FAMLITask,
                 sample_name=sample_name,
-                output_folder=os.path.join(
-                    self.base_s3_folder,
-                    self.output_folder
-                ),
+                output_folder=famli_output_folder,
                 threads=self.famli_threads,
                 temp_folder=self.temp_folder,
                 containerinfo=sl.ContainerInfo(
-                    vcpu=int(self.famli_threads),
-                    mem=int(self.famli_mem),
-                    engine=self.engine,
-                    aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                    aws_batch_job_poll_sec=120,
-                    aws_jobRoleArn=self.aws_job_role_arn,
-                    aws_batch_job_queue=self.aws_batch_job_queue,
-                    aws_batch_job_prefix="famli_{}".format(sample_name),
-                    mounts={
-                        "/docker_scratch": {
-                            "bind": self.temp_folder,
-                            "mode": "rw"
-                        }
-                    }
+                    vcpu=famli_threads,
+                    mem=famli_mem,
+                    **container_kwargs,
+                    aws_batch_job_prefix=f"famli_{sample_name}"
                 )
             )
             # Connect the raw FASTQ input
@@ -271,10 +248,5 @@ if __name__ == "__main__":
 
     sl.run(
         main_task_cls = MapFamliWorkflow,
-        cmdline_args = [
-            "--{}={}".format(
-                k.replace("_", "-"),
-                v)
-            for k, v in args.__dict__.items()
-        ]
+        cmdline_args = sciluigi_cmdline_args(args)
     )
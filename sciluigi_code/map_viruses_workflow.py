@@ -2,11 +2,14 @@
 """Map a set of samples against a viral reference database."""
 
 import os
-import re
 import argparse
-import pandas as pd
 import sciluigi as sl
 from general_tasks import LoadFile
+from general_tasks import read_metadata
+from general_tasks import batch_job_name
+from general_tasks import batch_container_kwargs
+from general_tasks import docker_scratch_mount
+from general_tasks import sciluigi_cmdline_args
 from viral_db_tasks import MapVirusesTask
 from viral_db_tasks import VirFinderTask
 from assembly_tasks import AssembleMetaSPAdes
@@ -43,13 +46,12 @@ class MapVirusesWorkflow(sl.WorkflowTask):
         assert self.input_location in ["SRA", "S3"]
 
         # Read in the metadata sheet
-        metadata = pd.read_table(self.metadata_fp, sep=self.metadata_fp_sep)
-        for col_name in [self.input_column_name, self.sample_column_name]:
-            assert col_name in metadata.columns, "{} not found in {}".format(
-                col_name, self.metadata_fp
-            )
-            # Make sure that all samples and files are unique
-            assert metadata[col_name].unique().shape[0] == metadata.shape[0]
+        sample_rows = read_metadata(
+            self.metadata_fp,
+            self.metadata_fp_sep,
+            self.sample_column_name,
+            self.input_column_name
+        )
 
         # Make tasks that will make sure the reference databases exist
         ref_db_dmnd = self.new_task(
@@ -63,6 +65,17 @@ class MapVirusesWorkflow(sl.WorkflowTask):
             path=self.ref_db_metadata
         )
 
+        container_kwargs = batch_container_kwargs(self)
+        scratch_mount = docker_scratch_mount(self.temp_folder)
+        align_threads = int(self.align_threads)
+        align_mem = int(self.align_mem)
+        assemble_threads = int(self.assemble_threads)
+        assemble_mem = int(self.assemble_mem)
+
+        # Folders for the outputs of each step
+        mapping_output_folder = os.path.join(self.base_s3_folder, self.mapping_output_folder)
+        metaspades_output_folder = os.path.join(self.base_s3_folder, "metaspades")
+
         # Keep track of all of the jobs for getting the input files
         tasks_load_inputs = {}
 
@@ -76,124 +89,86 @@ class MapVirusesWorkflow(sl.WorkflowTask):
         tasks_virfinder = {}
 
         # Iterate over all of the rows of samples
-        for ix, r in metadata.iterrows():
-
-            # Get the sample name and the file location
-            sample_name = r[self.sample_column_name]
-            input_path = r[self.input_column_name]
+        for sample_name, input_path in sample_rows:
 
             # If the inputs are on SRA, execute jobs that will download them
             if self.input_location == "SRA":
 
                 tasks_load_inputs[sample_name] = self.new_task(
-                    "download_from_sra_{}".format(sample_name),
+                    f"download_from_sra_{sample_name}",
                     ImportSRAFastq,
                     sra_accession=input_path,
                     base_s3_folder=self.base_s3_folder,
                     containerinfo=sl.ContainerInfo(
                         vcpu=1,
                         mem=4096,
-                        engine=self.engine,
-                        aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                        aws_jobRoleArn=self.aws_job_role_arn,
-                        aws_batch_job_queue=self.aws_batch_job_queue,
-                        aws_batch_job_prefix=re.sub(
-                            '[^a-zA-Z0-9-_]', '_',
-                            "download_from_sra_{}".format(sample_name)
+                        **container_kwargs,
+                        aws_batch_job_prefix=batch_job_name(
+                            f"download_from_sra_{sample_name}"
                         ),
-                        mounts={
-                            "/docker_scratch": {
-                                "bind": self.temp_folder,
-                                "mode": "rw"
-                            }
-                        }
+                        mounts=scratch_mount
                     )
                 )
             else:
                 # Make sure the file exists on S3
                 assert self.input_location == "S3"
                 tasks_load_inputs[sample_name] = self.new_task(
-                    "load_from_s3_{}".format(sample_name),
+                    f"load_from_s3_{sample_name}",
                     LoadFile,
                     path=input_path
                 )
 
             # Make a task to align the reads, wherever they came from
             tasks_map_viruses[sample_name] = self.new_task(
-                "map_viruses_{}".format(sample_name),
+                f"map_viruses_{sample_name}",
                 MapVirusesTask,
-                output_folder=os.path.join(self.base_s3_folder, self.mapping_output_folder),
+                output_folder=mapping_output_folder,
                 sample_name=sample_name,
                 threads=self.align_threads,
                 temp_folder=self.temp_folder,
                 containerinfo=sl.ContainerInfo(
-                    vcpu=int(self.align_threads),
-                    mem=int(self.align_mem),
-                    engine=self.engine,
-                    aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                    aws_jobRoleArn=self.aws_job_role_arn,
-                    aws_batch_job_queue=self.aws_batch_job_queue,
-                    aws_batch_job_prefix=re.sub(
-                        '[^a-zA-Z0-9-_]', '_',
-                        "map_viruses_{}".format(sample_name)
+                    vcpu=align_threads,
+                    mem=align_mem,
+                    **container_kwargs,
+                    aws_batch_job_prefix=batch_job_name(
+                        f"map_viruses_{sample_name}"
                     ),
-                    mounts={
-                        "/docker_scratch": {
-                            "bind": self.temp_folder,
-                            "mode": "rw"
-                        }
-                    }
+                    mounts=scratch_mount
                 )
             )
 
             # De novo assembly with metaSPAdes
             tasks_metaspades[sample_name] = self.new_task(
-                "metaspades_{}".format(sample_name),
+                f"metaspades_{sample_name}",
                 AssembleMetaSPAdes,
                 sample_name=sample_name,
-                output_folder=os.path.join(
-                    self.base_s3_folder,
-                    "metaspades"
-                ),
+                output_folder=metaspades_output_folder,
                 threads=self.assemble_threads,
-                max_mem=int(int(self.assemble_mem)/1000),
+                max_mem=int(assemble_mem/1000),
                 temp_folder=self.temp_folder,
                 containerinfo=sl.ContainerInfo(
-                    vcpu=int(self.assemble_threads),
-                    mem=int(self.assemble_mem),
-                    engine=self.engine,
-                    aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                    aws_jobRoleArn=self.aws_job_role_arn,
-                    aws_batch_job_queue=self.aws_batch_job_queue,
-                    aws_batch_job_prefix=re.sub(
-                        '[^a-zA-Z0-9-_]', '_',
-                        "metaspades_{}".format(sample_name)
+                    vcpu=assemble_threads,
+                    mem=assemble_mem,
+                    **container_kwargs,
+                    aws_batch_job_prefix=batch_job_name(
+                        f"metaspades_{sample_name}"
                     ),
-                    mounts={
-                        "/docker_scratch": {
-                            "bind": self.temp_folder,
-                            "mode": "rw"
-                        }
-                    }
+                    mounts=scratch_mount
                 )
             )
 
             # Run VirFinder on the assembled contigs
             tasks_virfinder[sample_name] = self.new_task(
-                "virfinder_{}".format(sample_name),
+                f"virfinder_{sample_name}",
                 VirFinderTask,
                 base_s3_folder=self.base_s3_folder,
                 sample_name=sample_name,
                 containerinfo=sl.ContainerInfo(
-                    vcpu=int(self.align_threads),
-                    mem=int(self.align_mem),
-                    engine=self.engine,
-                    aws_s3_scratch_loc=self.aws_s3_scratch_loc,
-                    aws_jobRoleArn=self.aws_job_role_arn,
-                    aws_batch_job_queue=self.aws_batch_job_queue,
-                    aws_batch_job_prefix=re.sub(
-                        '[^a-zA-Z0-9-_]', '_',
-                        "virfinder_{}".format(sample_name)
+                    vcpu=align_threads,
+                    mem=align_mem,
+                    **container_kwargs,
+                    aws_batch_job_prefix=batch_job_name(
+                        f"virfinder_{sample_name}"
                     ),
                 )
             )
@@ -346,10 +321,5 @@ if __name__ == "__main__":
 
     sl.run(
         main_task_cls=MapVirusesWorkflow,
-        cmdline_args=[
-            "--{}={}".format(
-                k.replace("_", "-"), 
-                v)
-            for k, v in args.__dict__.items()
-        ]
+        cmdline_args=sciluigi_cmdline_args(args)
     )
@@ -1,8 +1,9 @@
 import os
 import sciluigi as sl
+from general_tasks import CachedCompleteMixin
 
 
-class ImportSRAFastq(sl.ContainerTask):
+class ImportSRAFastq(CachedCompleteMixin, sl.ContainerTask):
     # Parameter: SRA accession to download data from
     sra_accession = sl.Parameter()
 
@@ -12,9 +13,16 @@ class ImportSRAFastq(sl.ContainerTask):
     # Scratch directory
     scratch_directory = sl.Parameter(default="/scratch")
 
+    # Parameter: Number of times to try the download before giving up
+    download_attempts = sl.Parameter(default=3)
+
     # URL of the container
     container = "quay.io/fhcrc-microbiome/get_sra:v0.3"
 
+    # Schedule downloads ahead of any other pending jobs, so that the inputs
+    # for later samples are fetched while earlier samples are being analyzed
+    priority = 100
+
     def out_fastq(self):
         # Output is an S3 object
         return sl.ContainerTargetInfo(
@@ -28,14 +36,24 @@ class ImportSRAFastq(sl.ContainerTask):
 
     def run(self):
 
+        get_sra = " ".join([
+            "get_sra.py",
+            "--accession",
+            self.sra_accession,
+            "--output-path",
+            self.out_fastq().path,
+            "--temp-folder",
+            self.scratch_directory
+        ])
+
+        # Transfers from SRA fail intermittently under load, so retry the
+        # download in place (with an increasing delay) instead of failing the
+        # whole job and waiting for it to be resubmitted. The attempts are
+        # written out in full because the command is templated with "$"
+        attempts = [get_sra] + [
+            "(sleep {} && {})".format(30 * 2 ** ix, get_sra)
+            for ix in range(int(self.download_attempts) - 1)
+        ]
         self.ex(
-            command=" ".join([
-                "get_sra.py",
-                "--accession",
-                self.sra_accession,
-                "--output-path",
-                self.out_fastq().path,
-                "--temp-folder",
-                self.scratch_directory
-            ])
+            command=" || ".join(attempts)
         )
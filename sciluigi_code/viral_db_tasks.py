@@ -1,8 +1,9 @@
 import os
 import sciluigi as sl
+from general_tasks import CachedCompleteMixin
 
 
-class MapVirusesTask(sl.ContainerTask):
+class MapVirusesTask(CachedCompleteMixin, sl.ContainerTask):
 
     # Inputs: FASTQ and reference database
     in_fastq = None